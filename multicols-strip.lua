@@ -0,0 +1,25 @@
+-- Pandoc Lua filter used by tex_to_epub.py.
+-- Removes what the LaTeX {multicols} environment leaves in Pandoc's output:
+-- the <div class="multicols"> wrapper (its content is kept) and the
+-- column-count paragraph, e.g. <p><span>2</span></p>.
+
+local function is_number_span(inline)
+  return inline.t == "Span"
+    and inline.identifier == ""
+    and #inline.classes == 0
+    and #inline.content == 1
+    and inline.content[1].t == "Str"
+    and inline.content[1].text:match("^%d+$") ~= nil
+end
+
+function Para(para)
+  if #para.content == 1 and is_number_span(para.content[1]) then
+    return {}
+  end
+end
+
+function Div(div)
+  if div.classes:includes("multicols") then
+    return div.content
+  end
+end
@@ -1,36 +1,468 @@
 import json
+import logging
 import os
 from pathlib import Path
 from ebooklib import epub
 import subprocess
 import re
-from shutil import copyfile
+import hashlib
+import glob
+import tarfile
+import tempfile
+import zipfile
+import socket
+import time
+import urllib.request
+import sys
+import threading
+from functools import lru_cache
+from shutil import copyfile, copyfileobj, move, which
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+# Optional: orjson is a faster drop-in for reading/writing JSON
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Optional: with Pillow, raster images are re-encoded in-process instead of with ImageMagick
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+CACHE_DIR = ".tex2epub_cache"
+# Safe extraction of the cached media tarballs, where this Python supports it (3.12+, backports)
+_TAR_EXTRACT_ARGS = {"filter": "data"} if hasattr(tarfile, "data_filter") else {}
+
+# Pandoc Lua filter stripping the {multicols} leftovers; remove_multicols_html() is the fallback
+_MULTICOLS_FILTER = Path(__file__).with_name("multicols-strip.lua")
+
+# Debug log; a file handler is attached by configure_debug_log() when "debug" is enabled
+logger = logging.getLogger("tex_to_epub")
+logger.propagate = False
+
+# Template partials ($partial()$ / ${ partial() }), LaTeX includes and local packages
+# (see _local_packages()) need file access, which the sandboxed Pandoc server does not have
+_TEMPLATE_PARTIAL_RE = re.compile(r'\$\{?\s*[\w./-]+\(\)')
+_TEX_FILE_ACCESS_RE = re.compile(rb'\\(?:input|include|subfile|import|subimport)\b')
+_TEX_PACKAGE_RE = re.compile(rb'\\(?:usepackage|RequirePackage)\s*(?:\[[^\]]*\]\s*)?\{([^}]*)\}')
+
+# Files a .tex source pulls in, hashed into the Pandoc cache key by _referenced_files()
+_TEX_INPUT_RE = re.compile(rb'\\(?:input|include)\s*\{([^}]*)\}')
+_TEX_GRAPHICS_RE = re.compile(rb'\\includegraphics\s*(?:\[[^\]]*\]\s*)?\{([^}]*)\}')
+# References _referenced_files() cannot follow (\input without braces, search paths, ...)
+_TEX_UNTRACKED_RE = re.compile(rb'\\input(?![a-zA-Z])(?!\s*\{)|\\(?:graphicspath|import|subimport|subfile)\b')
+# Extensions tried for \input/\include and \includegraphics names given without one
+_TEX_INPUT_EXTS = ("", ".tex")
+_TEX_GRAPHICS_EXTS = ("", ".pdf", ".png", ".jpg", ".jpeg", ".eps", ".svg", ".gif")
+
+# Patterns shared by all chapters, compiled once
+# Tokens remove_multicols_html() looks at: <div> tags and the column-count paragraph
+_MULTICOLS_RE = re.compile(r'<div\b[^>]*>|</div>|<p><span>\d+</span></p>')
+_CLASS_ATTR_RE = re.compile(r'\bclass="([^"]*)"')
+_MULTICOLS_SPAN_RE = re.compile(r'<p><span>\d+</span></p>')
+# Fixed tokens of Pandoc's image placeholder span, found with str.find by _iter_image_placeholders()
+_PLACEHOLDER_OPEN = '<span class="image placeholder"'
+_PLACEHOLDER_SRC = 'data-original-image-src="'
+_PLACEHOLDER_CLOSE = '</span>'
+
+# Byte marker of the markup rewritten by replace_image_references_in_html()
+_TRANSFORM_MARKER = b'data-original-image-src='
+
+
+# Image extensions packaged by add_media_to_epub(), with their MIME types
+_MIME = {
+    "jpg": "image/jpeg",
+    "jpeg": "image/jpeg",
+    "png": "image/png",
+    "gif": "image/gif",
+    "svg": "image/svg+xml",
+    "webp": "image/webp",
+}
+
+# Already-compressed formats: deflating them again costs CPU and saves nothing
+_STORED_MEDIA_TYPES = frozenset({"image/jpeg", "image/png", "image/gif", "image/webp"})
+# Deflate level for everything else (XHTML, CSS, XML): level 1 gets most of the gain of 6-9 at a fraction of the CPU
+_DEFLATE_LEVEL = 1
+
+# Seconds the Pandoc server may spend on one material ("pandocTimeout" in the config);
+# its own default of 2 s is too short for large chapters
+DEFAULT_PANDOC_TIMEOUT = 120
+
+# Default upper bound for the width of converted images, in pixels ("maxWidth" in the config)
+DEFAULT_MAX_WIDTH = 1200
+
+# Images below these sizes (and no wider than max_width) are packaged as they are, see _reusable_as_is()
+_REUSE_JPEG_MAX_BYTES = 500 * 1024
+_REUSE_PNG_MAX_BYTES = 16 * 1024
+
+# Raster images with at most this many colors (per mode) are line art and stay PNG
+_LINE_ART_MAX_COLORS = {"L": 16, "LA": 16}
+_LINE_ART_DEFAULT_MAX_COLORS = 256
+
+# Names of converted images (see _jpeg_target()), kept out of the cached Pandoc media
+_CONVERTED_NAME_RE = re.compile(r'-[0-9a-f]{8}\.q\d+(?:-d\d+)?-w\d+\.(?:jpg|png)$')
+# First-page size and rotation in the output of poppler's pdfinfo
+_PDFINFO_SIZE_RE = re.compile(rb'^Page size:\s*([\d.]+) x ([\d.]+)', re.MULTILINE)
+_PDFINFO_ROT_RE = re.compile(rb'^Page rot:\s*(\d+)', re.MULTILINE)
+# /MediaBox [x0 y0 x1 y1] of a PDF page, in points
+_PDF_MEDIABOX_RE = re.compile(rb'/MediaBox\s*\[\s*([-\d.]+)\s+([-\d.]+)\s+([-\d.]+)\s+([-\d.]+)\s*\]')
+
+# (resolved source path, quality, dpi, max_width) -> compressed image (.jpg or .png), filled by compress_image()
+_compressed_image_cache = {}
 
 def remove_multicols_html(html_content):
     """
     Removes extra HTML fragments left by {multicols} environment in LaTeX.
     For example, Pandoc might produce <div class="multicols"><p><span>2</span></p> ... </div>.
-    We want to remove such <div> tags and <p><span>2</span></p> lines.
-    """
-    # Remove <div class="multicols">
-    html_content = html_content.replace('<div class="multicols">', '')
-    # Remove </div>
-    html_content = html_content.replace('</div>', '')
-    # Remove lines like <p><span>2</span></p>
-    html_content = re.sub(r'<p><span>\d+</span></p>', '', html_content)
-    return html_content
-
-def compress_image_to_jpeg(src_path, quality=60, dpi=150):
-    """
-    Converts any image (PDF, PNG, JPG, etc.) to a .jpg file with a given quality (e.g. 60).
-    - For PDFs: takes only the first page ([0]) and uses -density <dpi>.
-    - For other formats (PNG/JPG/etc.): simply re-encodes at the given quality.
-    Returns the path to the resulting .jpg file or None if an error occurs.
+    We want to remove such <div> wrappers (keeping their content) and <p><span>2</span></p> lines,
+    exactly like the multicols-strip.lua filter: other <div>s and their </div> are kept.
+    Only used where the filter cannot run (the Pandoc server, or the filter file
+    missing next to the script).
+    """
+    if "multicols" not in html_content:
+        # No wrapper to unwrap: skip the walk over every <div> (a literal search is far cheaper)
+        if "<p><span>" not in html_content:
+            return html_content
+        return _MULTICOLS_SPAN_RE.sub('', html_content)
+
+    parts = []
+    start = 0
+    # One entry per open <div>: True if it is a multicols wrapper
+    open_divs = []
+    for match in _MULTICOLS_RE.finditer(html_content):
+        token = match.group()
+        if token.startswith("<div"):
+            classes = _CLASS_ATTR_RE.search(token)
+            strip = classes is not None and "multicols" in classes.group(1).split()
+            open_divs.append(strip)
+        elif token == "</div>":
+            strip = open_divs.pop() if open_divs else False
+        else:
+            strip = True
+        if strip:
+            parts.append(html_content[start:match.start()])
+            start = match.end()
+
+    if not start:
+        return html_content
+    parts.append(html_content[start:])
+    return "".join(parts)
+
+def load_json(file):
+    """
+    Parses JSON from an open (binary or text) file, with orjson if it is installed.
+    """
+    if orjson is not None:
+        return orjson.loads(file.read())
+    return json.load(file)
+
+def dump_json(obj, indent=False):
+    """
+    Serializes `obj` to UTF-8 JSON bytes, with orjson if it is installed.
+    """
+    if orjson is not None:
+        return orjson.dumps(obj, option=orjson.OPT_INDENT_2 if indent else 0)
+    return json.dumps(obj, indent=2 if indent else None).encode("utf-8")
+
+def _pdf_page_width(pdf_path):
+    """
+    Returns the width (in points) of the first page of the PDF, or None.
+    Asks poppler's pdfinfo (installed along with pdftoppm), which also reads PDFs with
+    compressed object streams, like pdfTeX's. Without it, falls back to the first
+    /MediaBox in the first 1 MiB of the file.
+    """
+    if which("pdfinfo"):
+        try:
+            info = subprocess.run(
+                ["pdfinfo", str(pdf_path)],
+                check=True,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.DEVNULL
+            ).stdout
+        except (OSError, subprocess.CalledProcessError):
+            info = b""
+        size = _PDFINFO_SIZE_RE.search(info)
+        if size:
+            rotation = _PDFINFO_ROT_RE.search(info)
+            # A page turned by 90 or 270 degrees is rendered as wide as it is tall
+            if rotation and int(rotation.group(1)) % 180:
+                return float(size.group(2))
+            return float(size.group(1))
+
+    try:
+        with open(pdf_path, "rb") as f:
+            match = _PDF_MEDIABOX_RE.search(f.read(1 << 20))
+    except OSError:
+        return None
+    if not match:
+        return None
+    return abs(float(match.group(3)) - float(match.group(1)))
+
+def _pdftoppm_to_jpeg(pdf_path, jpg_path, quality, dpi, max_width):
+    """
+    Rasterizes the first page of a PDF with poppler's pdftoppm, which is much
+    faster than ImageMagick's Ghostscript delegate. Pages that would come out
+    wider than max_width are scaled down to it.
+    """
+    command = [
+        "pdftoppm", "-jpeg",
+        "-jpegopt", f"quality={quality}",
+        "-r", str(dpi),
+        "-f", "1", "-singlefile",
+    ]
+    page_width = _pdf_page_width(pdf_path)
+    if max_width and page_width and page_width / 72 * dpi > max_width:
+        command.extend(["-scale-to-x", str(max_width), "-scale-to-y", "-1"])
+    # pdftoppm appends the .jpg extension itself
+    command.extend([str(pdf_path), str(jpg_path.with_suffix(""))])
+    subprocess.run(command, check=True)
+
+@lru_cache(maxsize=None)
+def _resolved(path):
+    """
+    Path.resolve() memoized for the compress_image() memo keys,
+    so an image referenced many times costs one realpath walk.
+    """
+    return path.resolve()
+
+def _jpeg_target(src_path, quality, dpi, max_width, dst_dir=None):
+    """
+    Returns where the .jpg for `src_path` goes: <name>-<id>.q<quality>[-d<dpi>]-w<max_width>.jpg
+    in `dst_dir`, or next to the source. <id> is a short hash of the source path (relative to
+    that folder), so fig.png and fig.jpg, or fig.png in two subfolders, get different outputs.
+    The encode settings are part of the name, so a run with other settings never mistakes
+    this file for its own output.
+    """
+    out_dir = Path(dst_dir or src_path.parent)
+    source_id = hashlib.blake2b(os.path.relpath(src_path, out_dir).encode("utf-8"), digest_size=4).hexdigest()
+    density = f"-d{dpi}" if src_path.suffix.lower() == ".pdf" else ""
+    return out_dir / f"{src_path.stem}-{source_id}.q{quality}{density}-w{max_width or 0}.jpg"
+
+def _remove_stale_outputs(jpg_path, keep):
+    """
+    Deletes what runs with other settings wrote for the same source (the other
+    <name>-<id>.q*.jpg/.png next to `jpg_path`, see _jpeg_target()), which
+    add_media_to_epub() would otherwise package too. `keep` is this run's output.
+    """
+    prefix = jpg_path.name[:jpg_path.name.rindex(".q")]
+    for old_path in jpg_path.parent.glob(glob.escape(prefix) + ".q*"):
+        if old_path != keep and old_path.suffix in (".jpg", ".png"):
+            try:
+                old_path.unlink()
+            except OSError:
+                pass
+
+def _cached_image(src_path, quality, dpi, max_width, dst_dir=None):
+    """
+    Returns the already-compressed image (.jpg or .png) for `src_path` (from the memo,
+    or an up-to-date output of a previous run with the same settings), or None if it
+    still has to be converted.
+    If the memo has it outside `dst_dir`, it is linked (or copied) there.
+    Line art kept as PNG (see _pillow_compress()) is found as a .png next to the .jpg path.
+    """
+    jpg_path = _jpeg_target(src_path, quality, dpi, max_width, dst_dir)
+    cache_key = (_resolved(src_path), quality, dpi, max_width)
+    cached = _compressed_image_cache.get(cache_key)
+    if cached and cached.is_file():
+        if not dst_dir:
+            return cached
+        target_path = Path(dst_dir) / cached.name
+        if cached == target_path:
+            return cached
+        try:
+            link_or_copy(cached, target_path)
+        except OSError:
+            return None
+        # The link shares its inode with the cached image, so never re-encode it in place
+        _compressed_image_cache[(_resolved(target_path), quality, dpi, max_width)] = target_path
+        _remove_stale_outputs(jpg_path, target_path)
+        return target_path
+
+    # Skip the conversion if a previous run already produced an up-to-date .jpg (or .png)
+    for out_path in (jpg_path, jpg_path.with_suffix(".png")):
+        if out_path != src_path and out_path.is_file() \
+                and out_path.stat().st_mtime >= src_path.stat().st_mtime:
+            _compressed_image_cache[cache_key] = out_path
+            _remove_stale_outputs(jpg_path, out_path)
+            return out_path
+
+    return None
+
+def _jpeg_width(jpg_path):
+    """
+    Returns the width of a JPEG from its SOF (start of frame) header, or None.
+    Walks the marker segments without decoding anything; used when Pillow is not installed.
+    """
+    try:
+        with open(jpg_path, "rb") as f:
+            if f.read(2) != b"\xff\xd8":
+                return None
+            while True:
+                marker = f.read(2)
+                while marker[:1] == b"\xff" and marker[1:] == b"\xff":
+                    # Fill bytes before the marker
+                    marker = marker[1:] + f.read(1)
+                if len(marker) < 2 or marker[0] != 0xFF:
+                    return None
+                kind = marker[1]
+                if kind == 0x01 or 0xD0 <= kind <= 0xD7:
+                    # Markers without a segment
+                    continue
+                length = f.read(2)
+                if len(length) < 2 or kind == 0xD9 or kind == 0xDA:
+                    # End of image, or the image data starts before any frame header
+                    return None
+                if 0xC0 <= kind <= 0xCF and kind not in (0xC4, 0xC8, 0xCC):
+                    header = f.read(5)
+                    return int.from_bytes(header[3:5], "big") if len(header) == 5 else None
+                f.seek(int.from_bytes(length, "big") - 2, os.SEEK_CUR)
+    except OSError:
+        return None
+
+def _reusable_as_is(src_path, max_width):
+    """
+    Tells whether an image can go into the ePub unchanged: a JPEG under
+    _REUSE_JPEG_MAX_BYTES, or a palette PNG under _REUSE_PNG_MAX_BYTES, that is
+    no wider than max_width. Re-encoding those costs a decode/encode (or an
+    ImageMagick start) and saves next to nothing.
+    Without Pillow, PNGs are never reused and the width of JPEGs is read by _jpeg_width().
+    """
+    suffix = src_path.suffix.lower()
+    if suffix in (".jpg", ".jpeg"):
+        max_bytes, modes = _REUSE_JPEG_MAX_BYTES, ("L", "RGB")
+    elif suffix == ".png":
+        max_bytes, modes = _REUSE_PNG_MAX_BYTES, ("1", "P")
+    else:
+        return False
+
+    try:
+        if src_path.stat().st_size >= max_bytes:
+            return False
+    except OSError:
+        return False
+
+    if Image is None:
+        if suffix == ".png":
+            return False
+        width = _jpeg_width(src_path)
+        return width is not None and not (max_width and width > max_width)
+    try:
+        # Only reads the header
+        with Image.open(src_path) as im:
+            return im.mode in modes and not (max_width and im.width > max_width)
+    except Exception:
+        return False
+
+def _is_line_art(im):
+    """
+    Tells whether a decoded image is line art (diagrams, plots, screenshots of text):
+    bilevel/palette images, or few distinct colors. Those compress better, and without
+    JPEG ringing, as a palette PNG.
+    """
+    if im.mode in ("1", "P"):
+        return True
+    max_colors = _LINE_ART_MAX_COLORS.get(im.mode, _LINE_ART_DEFAULT_MAX_COLORS)
+    return im.getcolors(maxcolors=max_colors) is not None
+
+def _pillow_compress(src_path, jpg_path, quality, max_width):
+    """
+    Re-encodes a raster image with Pillow, scaling it down to max_width if it is wider.
+    Photos become a 4:2:0 progressive JPEG at `jpg_path`; line art (see _is_line_art())
+    becomes a palette PNG next to it instead, keeping transparency.
+    Returns the path written.
+    Pillow releases the GIL while decoding/encoding, so this parallelizes well on threads.
+    """
+    with Image.open(src_path) as im:
+        line_art = _is_line_art(im)
+        has_alpha = im.mode in ("LA", "RGBA", "PA") or "transparency" in im.info
+        im = im.convert("RGBA" if line_art and has_alpha else "RGB")
+    if max_width and im.width > max_width:
+        im = im.resize((max_width, max(1, round(im.height * max_width / im.width))), Image.LANCZOS)
+
+    if line_art:
+        png_path = jpg_path.with_suffix(".png")
+        method = Image.Quantize.FASTOCTREE if im.mode == "RGBA" else Image.Quantize.MEDIANCUT
+        im.quantize(colors=256, method=method).save(png_path, "PNG", optimize=True)
+        return png_path
+
+    im.save(jpg_path, "JPEG", quality=quality, subsampling=2, qtables="web_high",
+            optimize=True, progressive=True)
+    return jpg_path
+
+def compress_image(src_path, quality=60, dpi=150, max_width=DEFAULT_MAX_WIDTH, dst_dir=None):
+    """
+    Converts any image (PDF, PNG, JPG, etc.) for the ePub: to a .jpg file with a given
+    quality (e.g. 60), or a palette .png for line art.
+    - For PDFs: takes only the first page, rendered at <dpi>, with pdftoppm if available
+      (falls back to ImageMagick with [0] and -density <dpi>).
+    - For other formats (PNG/JPG/etc.): simply re-encodes at the given quality,
+      in-process with Pillow if it is installed (falls back to ImageMagick).
+      With Pillow, line art is kept as a palette PNG instead (see _pillow_compress()).
+    Images wider than max_width pixels are scaled down to it.
+    The result is written straight to `dst_dir` if given, otherwise next to the source,
+    named after the source and the settings (see _jpeg_target()); outputs of the same
+    source with other settings are deleted.
+    Returns the path to the resulting .jpg (or .png) file or None if an error occurs.
     
     Note: Converting PNG→JPG will remove alpha transparency.
+    The source file itself is never written to.
+
+    Small JPEGs and palette PNGs (see _reusable_as_is()) are not converted at all.
+    Results are memoized per (source, quality, dpi, max_width), and an existing output with the
+    same settings that is newer than its source is reused, so each image is converted at most once.
     """
-    # We'll put the resulting .jpg in the same folder, changing only the extension.
-    jpg_path = src_path.with_suffix(".jpg")
+    jpg_path = _jpeg_target(src_path, quality, dpi, max_width, dst_dir)
+
+    cached = _cached_image(src_path, quality, dpi, max_width, dst_dir)
+    if cached:
+        return cached
+    cache_key = (_resolved(src_path), quality, dpi, max_width)
+    if src_path in (jpg_path, jpg_path.with_suffix(".png")):
+        # Already named like an output with these settings: keep it as it is
+        _compressed_image_cache[cache_key] = src_path
+        return src_path
+    if dst_dir:
+        os.makedirs(dst_dir, exist_ok=True)
+
+    # Small JPEGs and palette PNGs are used as they are (linked into place if needed)
+    if _reusable_as_is(src_path, max_width):
+        out_path = jpg_path.parent / src_path.name
+        try:
+            if out_path != src_path:
+                link_or_copy(src_path, out_path)
+                # The link shares its inode with the source, so never re-encode it in place
+                _compressed_image_cache[(_resolved(out_path), quality, dpi, max_width)] = out_path
+            _compressed_image_cache[cache_key] = out_path
+            _remove_stale_outputs(jpg_path, out_path)
+            return out_path
+        except OSError as e:
+            print(f"Warning: Could not reuse {src_path} as is, converting it: {e}")
+
+    # Fast path for PDFs: pdftoppm (poppler)
+    if src_path.suffix.lower() == ".pdf" and which("pdftoppm"):
+        try:
+            _pdftoppm_to_jpeg(src_path, jpg_path, quality, dpi, max_width)
+            _compressed_image_cache[cache_key] = jpg_path
+            _remove_stale_outputs(jpg_path, jpg_path)
+            return jpg_path
+        except Exception as e:
+            print(f"Warning: pdftoppm failed for {src_path}, trying ImageMagick: {e}")
+
+    # Fast path for raster images: Pillow, no subprocess
+    if src_path.suffix.lower() != ".pdf" and Image is not None:
+        try:
+            out_path = _pillow_compress(src_path, jpg_path, quality, max_width)
+            _compressed_image_cache[cache_key] = out_path
+            _remove_stale_outputs(jpg_path, out_path)
+            return out_path
+        except Exception as e:
+            print(f"Warning: Pillow failed for {src_path}, trying ImageMagick: {e}")
+
+    # "-resize WxH>" only ever shrinks
+    resize = ["-resize", f"{max_width}>"] if max_width else []
 
     # Build the ImageMagick command
     # - If PDF, we add "[0]" to convert only first page
@@ -39,153 +471,968 @@ def compress_image_to_jpeg(src_path, quality=60, dpi=150):
             "magick",
             "-density", str(dpi),
             f"{src_path}[0]",
+            *resize,
             "-quality", str(quality),
             str(jpg_path)
         ]
     else:
         # For PNG/JPG/etc., just convert and compress
-        # Optionally, you could set -resize or other params if you want smaller dimensions.
         command = [
             "magick",
             str(src_path),
+            *resize,
             "-quality", str(quality),
             str(jpg_path)
         ]
 
     try:
         subprocess.run(command, check=True)
+        _compressed_image_cache[cache_key] = jpg_path
+        _remove_stale_outputs(jpg_path, jpg_path)
         return jpg_path
     except Exception as e:
         print(f"Error compressing {src_path} to JPEG: {e}")
         return None
 
-def replace_image_references_in_html(html_content, media_dir, tex_dir):
+def batch_compress_to_jpeg(image_paths, quality=60, dpi=150, max_width=DEFAULT_MAX_WIDTH, dst_dir=None):
+    """
+    Converts every image in `image_paths` to a .jpg in `dst_dir` (default: next to it) with
+    a single `magick mogrify` process for all of them (PDFs: first page, rendered at
+    -density <dpi>; for raster images the density only sets the resolution metadata),
+    instead of one process per file.
+    Converted files are recorded in the compress_image() memo, so later
+    calls for the same image are free. If mogrify fails (or is not available),
+    nothing is recorded and compress_image() converts each file on its own.
+    When pdftoppm is installed, PDFs are left to compress_image(), which then
+    uses pdftoppm per file; that beats one ImageMagick/Ghostscript batch. Likewise,
+    raster images are left to it when Pillow is installed (no process at all).
+    """
+    use_pdftoppm = bool(which("pdftoppm"))
+    pending, inputs, stems = [], [], set()
+    for image_path in dict.fromkeys(image_paths):
+        if _cached_image(image_path, quality, dpi, max_width, dst_dir):
+            continue
+        if _reusable_as_is(image_path, max_width):
+            # compress_image() only links it into place
+            continue
+        if image_path.stem in stems:
+            # mogrify would write both to the same <name>.jpg; compress_image() converts this one
+            continue
+        if image_path.suffix.lower() == ".pdf":
+            if not use_pdftoppm:
+                pending.append(image_path)
+                inputs.append(f"{image_path}[0]")
+                stems.add(image_path.stem)
+        elif Image is None:
+            pending.append(image_path)
+            inputs.append(str(image_path))
+            stems.add(image_path.stem)
+    if not pending:
+        return
+
+    resize = ["-resize", f"{max_width}>"] if max_width else []
+    if dst_dir:
+        os.makedirs(dst_dir, exist_ok=True)
+
+    # mogrify writes <name>.jpg, which next to the source could be the source itself
+    # (or another file of the user), so it writes into a scratch folder instead
+    with tempfile.TemporaryDirectory(dir=dst_dir) as out_dir:
+        command = [
+            "magick", "mogrify", "-format", "jpg", "-path", out_dir,
+            "-density", str(dpi), *resize, "-quality", str(quality), *inputs
+        ]
+        try:
+            subprocess.run(command, check=True)
+        except Exception as e:
+            print(f"Warning: Batch image conversion failed, converting one by one: {e}")
+            return
+
+        for image_path in pending:
+            # Move the output to its name with the settings
+            jpg_path = _jpeg_target(image_path, quality, dpi, max_width, dst_dir)
+            try:
+                move(os.path.join(out_dir, image_path.stem + ".jpg"), jpg_path)
+            except OSError:
+                continue
+            _compressed_image_cache[(_resolved(image_path), quality, dpi, max_width)] = jpg_path
+            _remove_stale_outputs(jpg_path, jpg_path)
+
+def link_or_copy(src_path, dst_path):
+    """
+    Places `src_path` at `dst_path` as cheaply as possible: a hardlink first,
+    then a reflink (copy-on-write clone) on Linux, and a regular copy as the last resort.
+    Only use this for files that are not modified in place afterwards.
+    """
+    try:
+        if Path(dst_path).exists():
+            if os.path.samefile(src_path, dst_path):
+                return
+            os.remove(dst_path)
+        os.link(src_path, dst_path)
+        return
+    except OSError:
+        pass
+
+    if sys.platform.startswith("linux"):
+        try:
+            subprocess.run(
+                ["cp", "--reflink=auto", str(src_path), str(dst_path)],
+                check=True,
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL
+            )
+            return
+        except (OSError, subprocess.CalledProcessError):
+            pass
+
+    copyfile(src_path, dst_path)
+
+def find_image_file(image_file, media_dir, tex_dir, media_index=None):
+    """
+    Looks up an image referenced by Pandoc, first in media_dir (maybe Pandoc
+    already extracted it there), then in the .tex file directory.
+    If a `media_index` from build_media_index() is given, media_dir is looked up
+    in it instead of on disk.
+    Returns the Path to the image or None if it does not exist.
+    """
+    if media_index is not None:
+        indexed = media_index.get(os.path.normpath(image_file).replace(os.sep, "/"))
+        if indexed:
+            return Path(indexed)
+    elif media_dir:
+        candidate = Path(media_dir) / image_file
+        if candidate.is_file():
+            return candidate
+
+    candidate = Path(tex_dir) / image_file
+    if candidate.is_file():
+        return candidate
+
+    return None
+
+def _iter_image_placeholders(html_content):
+    """
+    Yields (start, end, image path) for every image placeholder span in the HTML.
+    Scans for the fixed tokens with str.find instead of a DOTALL regex, which keeps
+    large chapters out of the regex engine. Malformed spans are skipped.
+    """
+    find = html_content.find
+    pos = find(_PLACEHOLDER_OPEN)
+    while pos != -1:
+        tag_end = find('>', pos)
+        if tag_end == -1:
+            return
+        next_pos = tag_end + 1
+
+        src_start = find(_PLACEHOLDER_SRC, pos, tag_end)
+        if src_start != -1:
+            src_start += len(_PLACEHOLDER_SRC)
+            src_end = find('"', src_start, tag_end)
+            if src_end > src_start:
+                span_end = find(_PLACEHOLDER_CLOSE, tag_end)
+                if span_end == -1:
+                    return
+                span_end += len(_PLACEHOLDER_CLOSE)
+                yield pos, span_end, html_content[src_start:src_end]
+                next_pos = span_end
+
+        pos = find(_PLACEHOLDER_OPEN, next_pos)
+
+def _precompress_images(image_paths, media_dir, max_width=DEFAULT_MAX_WIDTH):
+    """
+    Compresses every image in `image_paths` (found by find_image_file())
+    up front, each image once however often it is referenced. The images are split
+    into one batch_compress_to_jpeg() call per worker thread, so ImageMagick starts
+    once per core rather than once per image; whatever a batch could not convert
+    goes through compress_image() on the same pool. The results land in
+    the compress_image() memo, so the placeholder rewrite afterwards is
+    only string work.
+    """
+    image_paths = list(dict.fromkeys(path for path in image_paths if path))
+    if not image_paths:
+        return
+
+    workers = min(os.cpu_count() or 1, len(image_paths))
+    batches = [image_paths[i::workers] for i in range(workers)]
+
+    # Each conversion is an external process, so threads are enough to keep all cores busy
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        list(executor.map(
+            lambda batch: batch_compress_to_jpeg(batch, quality=60, max_width=max_width, dst_dir=media_dir),
+            batches
+        ))
+        list(executor.map(
+            lambda path: compress_image(path, quality=60, max_width=max_width, dst_dir=media_dir),
+            image_paths
+        ))
+
+def _image_placeholder_to_img(whole_span, image_file, media_dir, tex_dir, media_index=None,
+                              max_width=DEFAULT_MAX_WIDTH, img_tags=None, image_paths=None):
+    """
+    Returns the <img> tag replacing one image placeholder, compressing the image
+    into media_dir on the way, or `whole_span` unchanged if that fails.
+    The resulting image is recorded in `media_index`, if given.
+    `img_tags` ({image_file: <img> tag}) remembers successful replacements, so an
+    image referenced again in the same chapter costs no lookups or file operations.
+    `image_paths` ({image_file: Path or None}) holds images already looked up with find_image_file().
+    """
+    if img_tags is not None and image_file in img_tags:
+        return img_tags[image_file]
+
+    if image_paths is not None and image_file in image_paths:
+        final_image_path = image_paths[image_file]
+    else:
+        final_image_path = find_image_file(image_file, media_dir, tex_dir, media_index)
+    if not final_image_path:
+        print(f"Warning: Image file '{image_file}' not found.")
+        return whole_span
+
+    # Now compress/convert to .jpg (with quality ~60) or .png, written straight into media_dir
+    compressed_image = compress_image(
+        final_image_path,
+        quality=60,
+        max_width=max_width,
+        dst_dir=media_dir
+    )
+    if not compressed_image or not compressed_image.is_file():
+        print(f"Warning: Failed to compress '{image_file}' to JPG.")
+        return whole_span
+
+    if media_dir and media_index is not None:
+        media_index[compressed_image.name] = str(compressed_image)
+
+    img_tag = f'<img src="{compressed_image.name}" alt="image">'
+    if img_tags is not None:
+        img_tags[image_file] = img_tag
+    return img_tag
+
+def _rewrite_image_placeholders(html_content, media_dir, tex_dir, media_index=None,
+                                max_width=DEFAULT_MAX_WIDTH):
+    """
+    Replaces the image placeholders in the HTML with <img> tags in a single pass,
+    joining the untouched text between them and the new tags once at the end.
+    """
+    placeholders = list(_iter_image_placeholders(html_content))
+    if not placeholders:
+        return html_content
+
+    # Look up each referenced image once, however many placeholders point at it
+    image_paths = {
+        image_file: find_image_file(image_file, media_dir, tex_dir, media_index)
+        for image_file in dict.fromkeys(image_file for _, _, image_file in placeholders)
+    }
+
+    # Prepass: compress all referenced images in parallel
+    _precompress_images(image_paths.values(), media_dir, max_width)
+
+    img_tags = {}
+    pieces = []
+    last = 0
+    for start, end, image_file in placeholders:
+        pieces.append(html_content[last:start])
+        pieces.append(_image_placeholder_to_img(
+            html_content[start:end], image_file, media_dir, tex_dir, media_index, max_width, img_tags,
+            image_paths
+        ))
+        last = end
+    pieces.append(html_content[last:])
+    return ''.join(pieces)
+
+def replace_image_references_in_html(html_content, media_dir, tex_dir, media_index=None,
+                                     max_width=DEFAULT_MAX_WIDTH):
     """
     Replaces Pandoc's <span class="image placeholder" data-original-image-src="..."> 
     with <img src="...">. 
-    Additionally, compresses ALL images (PDF, PNG, JPG, etc.) to a .jpg with ~quality=60.
-    The final .jpg is placed in media_dir, so add_media_to_epub() can package it.
+    Additionally, compresses ALL images (PDF, PNG, JPG, etc.) with compress_image():
+    to a .jpg with ~quality=60, or a palette .png for line art.
+    The result is placed in media_dir, so add_media_to_epub() can package it.
+    Images wider than max_width pixels are scaled down.
+    `media_index` (see build_media_index()) replaces per-image lookups in media_dir.
     """
 
-    pattern = re.compile(
-        r'<span\s+class="image placeholder"([^>]*)data-original-image-src="([^"]+)"([^>]*)>(.*?)</span>',
-        flags=re.DOTALL
-    )
+    # Text-only chapter: skip the scan entirely
+    if _PLACEHOLDER_SRC not in html_content:
+        return html_content
 
-    def replace_placeholder(match):
-        whole_span = match.group(0)
-        image_file = match.group(2)
+    return _rewrite_image_placeholders(html_content, media_dir, tex_dir, media_index, max_width)
 
-        # Try media_dir first (maybe Pandoc already extracted it there)
-        final_image_path = None
-        if media_dir:
-            candidate = Path(media_dir) / image_file
-            if candidate.is_file():
-                final_image_path = candidate
-
-        # If not found, check the .tex file directory
-        if not final_image_path:
-            candidate = Path(tex_dir) / image_file
-            if candidate.is_file():
-                final_image_path = candidate
-
-        if not final_image_path or not final_image_path.is_file():
-            print(f"Warning: Image file '{image_file}' not found.")
-            return whole_span
-
-        # Now compress/convert to .jpg (with quality ~60)
-        compressed_jpg = compress_image_to_jpeg(final_image_path, quality=60)
-        if not compressed_jpg or not compressed_jpg.is_file():
-            print(f"Warning: Failed to compress '{image_file}' to JPG.")
-            return whole_span
-
-        # Ensure the final .jpg is in media_dir
-        if media_dir:
-            target_path = Path(media_dir) / compressed_jpg.name
-            target_path.parent.mkdir(parents=True, exist_ok=True)
-            if target_path != compressed_jpg:
-                try:
-                    copyfile(compressed_jpg, target_path)
-                    compressed_jpg = target_path
-                except Exception as e:
-                    print(f"Error copying '{compressed_jpg}' to '{target_path}': {e}")
-                    return whole_span
+@lru_cache(maxsize=None)
+def _multicols_filter_source():
+    """
+    Returns the contents of the multicols-strip.lua filter, or None if it is not next to the script.
+    """
+    try:
+        return _MULTICOLS_FILTER.read_bytes()
+    except OSError:
+        return None
+
+@lru_cache(maxsize=None)
+def _pandoc_version():
+    """
+    Returns the first bytes of `pandoc --version`, so a Pandoc upgrade invalidates the cache.
+    """
+    try:
+        return subprocess.check_output(["pandoc", "--version"])[:40]
+    except (OSError, subprocess.CalledProcessError):
+        return b""
+
+def _local_packages(tex_file, source):
+    """
+    Returns the .sty files of the \\usepackage/\\RequirePackage names in `source` that exist
+    next to `tex_file` or in the working directory; Pandoc reads those for their macros.
+    """
+    packages = []
+    for match in _TEX_PACKAGE_RE.finditer(source):
+        for name in match.group(1).decode("utf-8", "replace").split(","):
+            name = name.strip()
+            if not name:
+                continue
+            for base_dir in (Path(tex_file).parent, Path(".")):
+                candidate = base_dir / f"{name}.sty"
+                if candidate.is_file():
+                    packages.append(candidate)
+    return packages
+
+def _referenced_files(tex_file):
+    """
+    Returns the files `tex_file` pulls in: \\input/\\include files and local packages
+    (followed recursively) and \\includegraphics images, looked up relative to its folder and to the working
+    directory, where Pandoc resolves them. Returns None if the source uses references
+    this cannot follow (\\graphicspath, \\import, \\input without braces, ...).
+    """
+    base_dirs = (Path(tex_file).parent, Path("."))
+    found = {}
+    pending = [Path(tex_file)]
+    seen = set()
+    while pending:
+        source_path = pending.pop()
+        if source_path in seen:
+            continue
+        seen.add(source_path)
+        try:
+            source = source_path.read_bytes()
+        except OSError:
+            continue
+        if _TEX_UNTRACKED_RE.search(source):
+            return None
+
+        for pattern, extensions, follow in ((_TEX_INPUT_RE, _TEX_INPUT_EXTS, True),
+                                            (_TEX_GRAPHICS_RE, _TEX_GRAPHICS_EXTS, False)):
+            for match in pattern.finditer(source):
+                name = match.group(1).decode("utf-8", "replace").strip()
+                if not name:
+                    continue
+                for base_dir in base_dirs:
+                    for extension in extensions:
+                        candidate = base_dir / (name + extension)
+                        if candidate not in found and candidate.is_file():
+                            found[candidate] = None
+                            if follow:
+                                pending.append(candidate)
+        for candidate in _local_packages(tex_file, source):
+            if candidate not in found:
+                found[candidate] = None
+                pending.append(candidate)
+    return list(found)
+
+def _pandoc_cache_key(tex_file, template, extract_media):
+    """
+    Builds the cache key for a Pandoc run from the .tex source, the files it
+    includes (see _referenced_files()), the template, the multicols filter and
+    the Pandoc version.
+    Returns None if the source cannot be cached (its includes cannot be followed).
+    """
+    referenced = _referenced_files(tex_file)
+    if referenced is None:
+        return None
+
+    h = hashlib.blake2b()
+    h.update(str(tex_file).encode("utf-8"))
+    h.update(b"\0media" if extract_media else b"\0nomedia")
+    with open(tex_file, "rb") as f:
+        h.update(f.read())
+    # Included sources and figures: editing one invalidates the cached HTML and media
+    for path in sorted(referenced):
+        h.update(b"\0" + str(path).encode("utf-8") + b"\0")
+        with open(path, "rb", buffering=0) as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                h.update(chunk)
+    if template and Path(template).is_file():
+        with open(template, "rb") as f:
+            h.update(f.read())
+    h.update(_multicols_filter_source() or b"\0nofilter")
+    h.update(_pandoc_version())
+    return h.hexdigest()
+
+def _write_cache_file(path, write):
+    """
+    Writes a cache entry file via write(binary_file): into a temporary file next to
+    `path` first, then moved over it, so an interrupted run never leaves a partial entry.
+    """
+    fd, tmp_path = tempfile.mkstemp(dir=path.parent, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            write(f)
+        os.replace(tmp_path, path)
+    except BaseException:
+        Path(tmp_path).unlink(missing_ok=True)
+        raise
+
+def _write_media_tar(f, media_dir):
+    """
+    Packs media_dir (or nothing, if Pandoc extracted no images) into the open file `f`.
+    Images converted by earlier runs are left out: a cache hit must not bring back
+    outputs of other settings that _remove_stale_outputs() deleted.
+    """
+    def skip_converted(info):
+        return None if _CONVERTED_NAME_RE.search(info.name) else info
+
+    with tarfile.open(fileobj=f, mode="w") as tar:
+        if Path(media_dir).is_dir():
+            tar.add(media_dir, arcname=".", filter=skip_converted)
 
-        return f'<img src="{compressed_jpg.name}" alt="image">'
+def start_pandoc_server(timeout=DEFAULT_PANDOC_TIMEOUT):
+    """
+    Starts `pandoc server` on a free local port, so materials can be converted
+    over HTTP without paying Pandoc's startup cost for every file.
+    `timeout` is the server's limit, in seconds, for one conversion.
+    Returns (process, url), or (None, None) if the server could not be started.
+    """
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
 
-    new_html = pattern.sub(replace_placeholder, html_content)
-    return new_html
+    try:
+        process = subprocess.Popen(
+            ["pandoc", "server", "--port", str(port), "--timeout", str(max(1, int(timeout)))],
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL
+        )
+    except OSError:
+        return None, None
 
-def convert_tex_to_html(tex_file, template=None, extract_media=False, debug=False, log_file=None):
+    # Wait until the server accepts connections
+    for _ in range(50):
+        if process.poll() is not None:
+            return None, None
+        try:
+            with socket.create_connection(("127.0.0.1", port), timeout=0.1):
+                return process, f"http://127.0.0.1:{port}"
+        except OSError:
+            time.sleep(0.1)
+
+    stop_pandoc_server(process)
+    return None, None
+
+def stop_pandoc_server(process):
+    """
+    Terminates a server started by start_pandoc_server().
+    """
+    if process is None:
+        return
+    process.terminate()
+    try:
+        process.wait(timeout=5)
+    except subprocess.TimeoutExpired:
+        process.kill()
+
+class PandocServer:
+    """
+    A `pandoc server` shared by the Pandoc worker threads. It is only started by the
+    first material that needs it, so a book served entirely from the cache never starts it.
+    """
+
+    def __init__(self, timeout=DEFAULT_PANDOC_TIMEOUT):
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self._started = False
+        self._process = None
+        self._url = None
+
+    def url(self):
+        """
+        Returns the server URL, starting the server on the first call,
+        or None if it could not be started.
+        """
+        with self._lock:
+            if not self._started:
+                self._started = True
+                self._process, self._url = start_pandoc_server(self.timeout)
+            return self._url
+
+    def stop(self):
+        """
+        Stops the server if it was started.
+        """
+        with self._lock:
+            stop_pandoc_server(self._process)
+            self._process = None
+
+def _convert_via_server(server, tex_file, template):
+    """
+    Converts a .tex file with the Pandoc server (a PandocServer).
+    The server runs no Lua filters, so the {multicols} leftovers are removed with remove_multicols_html().
+    Returns the HTML as bytes, or None if the file should be converted with the pandoc CLI instead.
+    """
+    with open(tex_file, "rb") as f:
+        tex_source = f.read()
+    if _TEX_FILE_ACCESS_RE.search(tex_source) or _local_packages(tex_file, tex_source):
+        return None
+
+    try:
+        request = {"text": tex_source.decode("utf-8"), "from": "latex", "to": "html"}
+    except UnicodeDecodeError:
+        # The server only takes UTF-8 text; the CLI handles (or reports) other encodings
+        return None
+    if template:
+        # A template given by name (not a path) is resolved by the CLI from Pandoc's data dir
+        try:
+            with open(template, "r", encoding="utf-8") as f:
+                template_source = f.read()
+        except (OSError, UnicodeDecodeError):
+            return None
+        if _TEMPLATE_PARTIAL_RE.search(template_source):
+            return None
+        # Like the CLI, a custom template implies a standalone document
+        request["template"] = template_source
+        request["standalone"] = True
+
+    server_url = server.url()
+    if server_url is None:
+        return None
+    http_request = urllib.request.Request(
+        server_url,
+        data=dump_json(request),
+        headers={"Content-Type": "application/json", "Accept": "application/json"}
+    )
+    try:
+        # A little longer than the server's own limit, so a hung server cannot block a worker
+        with urllib.request.urlopen(http_request, timeout=server.timeout + 5) as response:
+            result = load_json(response)
+    except Exception:
+        return None
+    if "output" not in result:
+        return None
+
+    return remove_multicols_html(result["output"]).encode("utf-8")
+
+def convert_tex_to_html(tex_file, template=None, extract_media=False, debug=False, server=None):
     """
     Converts a .tex file to HTML via Pandoc.
+    The HTML is read from Pandoc's stdout and returned as bytes, without an intermediate .html file.
+    The {multicols} leftovers are stripped by the multicols-strip.lua filter
+    (or by remove_multicols_html() where the filter cannot be used).
     If extract_media=True, uses --extract-media to place images into a separate folder.
+    Results are cached in CACHE_DIR, so unchanged inputs (including \\input files and
+    figures, see _pandoc_cache_key()) skip Pandoc on the next run.
+    If a PandocServer is given, it is used where it can be
+    (no media extraction, no template partials, no included files or local packages); otherwise the CLI.
+    Returns (html_bytes, media_dir), or (None, None) if the conversion failed.
     """
-    output_html = tex_file.replace(".tex", ".html")
-    command = ["pandoc", tex_file, "-o", output_html]
+    command = ["pandoc", tex_file, "-t", "html"]
 
     if template:
         command.extend(["--template", template])
 
+    use_filter = _multicols_filter_source() is not None
+    if use_filter:
+        command.extend(["--lua-filter", str(_MULTICOLS_FILTER)])
+
     media_dir = None
     if extract_media:
         media_dir = tex_file.replace(".tex", "_media")
         command.extend(["--extract-media", media_dir])
 
+    cache_key = _pandoc_cache_key(tex_file, template, extract_media)
+    if cache_key is None:
+        logger.info(f"Not caching {tex_file}: it includes files that cannot be tracked.")
+    cached_html = cache_key and Path(CACHE_DIR) / f"{cache_key}.html"
+    cached_media = cache_key and Path(CACHE_DIR) / f"{cache_key}.media.tar"
+
+    if cached_html and cached_html.is_file():
+        try:
+            # The media tarball is written before the HTML, so it must be there too
+            if media_dir:
+                with tarfile.open(cached_media) as tar:
+                    tar.extractall(media_dir, **_TAR_EXTRACT_ARGS)
+            html_bytes = cached_html.read_bytes()
+        except (OSError, tarfile.TarError) as e:
+            # A damaged entry is only a cache miss
+            logger.info(f"Discarding the cached HTML for {tex_file}: {e}")
+            cached_html.unlink(missing_ok=True)
+            cached_media.unlink(missing_ok=True)
+        else:
+            logger.info(f"Using cached HTML for {tex_file}.")
+            return html_bytes, media_dir
+
+    html_bytes = None
+    if server and not extract_media:
+        html_bytes = _convert_via_server(server, tex_file, template)
+        if html_bytes is not None:
+            logger.info(f"Successfully converted {tex_file} to HTML (Pandoc server).")
+
+    if html_bytes is None:
+        try:
+            html_bytes = subprocess.run(
+                command,
+                check=True,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE if debug else subprocess.DEVNULL
+            ).stdout
+            logger.info(f"Successfully converted {tex_file} to HTML.")
+        except (OSError, subprocess.CalledProcessError) as e:
+            logger.info(f"Error converting {tex_file} to HTML: {e}")
+            return None, None
+        if not use_filter:
+            html_bytes = remove_multicols_html(html_bytes.decode("utf-8")).encode("utf-8")
+
+    # Store the fresh result (and extracted media, if any) for the next run
+    if not cache_key:
+        return html_bytes, media_dir
+    # The HTML goes last: its presence marks a complete entry
     try:
-        subprocess.run(
-            command,
-            check=True,
-            stdout=subprocess.PIPE if debug else subprocess.DEVNULL,
-            stderr=subprocess.PIPE if debug else subprocess.DEVNULL
-        )
-        if debug and log_file:
-            with open(log_file, "a") as log:
-                log.write(f"Successfully converted {tex_file} to HTML.\n")
-    except subprocess.CalledProcessError as e:
-        if debug and log_file:
-            with open(log_file, "a") as log:
-                log.write(f"Error converting {tex_file} to HTML: {e}\n")
-        return None, None
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        if media_dir:
+            _write_cache_file(cached_media, lambda f: _write_media_tar(f, media_dir))
+        _write_cache_file(cached_html, lambda f: f.write(html_bytes))
+    except Exception as e:
+        print(f"Warning: Could not cache HTML for '{tex_file}': {e}")
 
-    return output_html, media_dir
+    return html_bytes, media_dir
 
-def add_media_to_epub(media_dir, book):
+def configure_debug_log(log_file):
     """
-    Scans `media_dir` and adds recognized image files to the ePub.
-    This ensures they are included in the final output.epub package.
+    Points the module logger at `log_file` (or disables it when log_file is None).
+    The file is overwritten and kept open; the Pandoc worker threads log through it too.
     """
-    if not media_dir or not Path(media_dir).is_dir():
+    for handler in logger.handlers[:]:
+        logger.removeHandler(handler)
+        handler.close()
+
+    if not log_file:
+        logger.setLevel(logging.CRITICAL + 1)
         return
 
-    for media_file in Path(media_dir).glob("**/*"):
-        suffix_lower = media_file.suffix.lower().strip(".")
-        if suffix_lower in ["jpg", "jpeg", "png", "gif", "svg"]:
-            with open(media_file, "rb") as f:
-                epub_item = epub.EpubItem(
-                    uid=media_file.name,
-                    file_name=media_file.name,
-                    media_type=f"image/{suffix_lower}",
-                    content=f.read()
+    handler = logging.FileHandler(log_file, mode="w")
+    handler.setFormatter(logging.Formatter("%(message)s"))
+    logger.addHandler(handler)
+    logger.setLevel(logging.INFO)
+
+def _scan_files(directory):
+    """
+    Recursively yields os.DirEntry objects for all files below `directory`.
+    Uses os.scandir, which gets the file type from the directory listing instead of a stat per entry.
+    """
+    stack = [directory]
+    while stack:
+        with os.scandir(stack.pop()) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+                elif entry.is_file():
+                    yield entry
+
+def build_media_index(media_dir):
+    """
+    Walks `media_dir` once and returns {path relative to media_dir (with "/"): file path}.
+    Shared by the image lookups and add_media_to_epub(), so each file is listed only once.
+    """
+    if not media_dir or not os.path.isdir(media_dir):
+        return {}
+    # Entries are yielded as os.path.join(media_dir, ...), so the relative path is a plain slice
+    # (os.path.relpath would normalize both paths again for every file)
+    prefix_len = len(os.path.join(media_dir, ""))
+    return {
+        entry.path[prefix_len:].replace(os.sep, "/"): entry.path
+        for entry in _scan_files(media_dir)
+    }
+
+def needs_html_transforms(html_bytes):
+    """
+    Tells whether the HTML contains any markup that replace_image_references_in_html() would rewrite.
+    """
+    return _TRANSFORM_MARKER in html_bytes
+
+class FileBackedContent:
+    """
+    Mixin for ebooklib items whose content stays on disk at `file_path`.
+    `content` is a property that reads the file on every access instead of keeping
+    the bytes on the item, so the book holds no image data until it is written,
+    and StreamingEpubWriter copies the file into the archive without reading it whole.
+    Assigning non-empty bytes to `content` overrides the file, as on a plain item.
+    """
+    file_path = None
+    _content = None
+
+    @property
+    def content(self):
+        if self._content is not None:
+            return self._content
+        if self.file_path:
+            with open(self.file_path, "rb") as f:
+                return f.read()
+        return b""
+
+    @content.setter
+    def content(self, value):
+        self._content = value or None
+
+class EpubFileItem(FileBackedContent, epub.EpubItem):
+    """
+    An EpubItem whose content stays on disk until the ePub is written.
+    """
+    def __init__(self, file_path, **kwargs):
+        super().__init__(**kwargs)
+        self.file_path = str(file_path)
+
+class EpubCoverFile(FileBackedContent, epub.EpubCover):
+    """
+    Disk-backed variant of the cover image item created by EpubBook.set_cover().
+    """
+    def __init__(self, file_path, **kwargs):
+        super().__init__(**kwargs)
+        self.file_path = str(file_path)
+
+class StreamingEpubWriter(epub.EpubWriter):
+    """
+    EpubWriter that streams disk-backed items (EpubFileItem, EpubCoverFile) into the
+    zip in 64 KiB chunks, so their bytes are never held in memory as a whole.
+    Already-compressed images are stored (ZIP_STORED); everything else is deflated
+    at the writer's "compresslevel" option (write_epub() passes _DEFLATE_LEVEL).
+    Other items are written exactly like ebooklib does.
+    """
+    @staticmethod
+    def _compress_type(item):
+        if getattr(item, "media_type", None) in _STORED_MEDIA_TYPES:
+            return zipfile.ZIP_STORED
+        return zipfile.ZIP_DEFLATED
+
+    def _write_file(self, item, arcname):
+        # Like ZipFile.write(), but copies in 64 KiB chunks instead of 8 KiB
+        zinfo = zipfile.ZipInfo.from_file(item.file_path, arcname)
+        zinfo.compress_type = self._compress_type(item)
+        # ZipInfo.from_file() leaves the level unset, which would mean zlib's default
+        zinfo._compresslevel = self.out.compresslevel
+        with open(item.file_path, "rb") as src, self.out.open(zinfo, "w") as dst:
+            copyfileobj(src, dst, 1 << 16)
+
+    def _write_items(self):
+        for item in self.book.get_items():
+            if isinstance(item, epub.EpubNcx):
+                self.out.writestr(f"{self.book.FOLDER_NAME}/{item.file_name}", self._get_ncx())
+            elif isinstance(item, epub.EpubNav):
+                self.out.writestr(f"{self.book.FOLDER_NAME}/{item.file_name}", self._get_nav(item))
+            elif isinstance(item, FileBackedContent) and item._content is None and item.manifest:
+                self._write_file(item, f"{self.book.FOLDER_NAME}/{item.file_name}")
+            elif item.manifest:
+                self.out.writestr(
+                    f"{self.book.FOLDER_NAME}/{item.file_name}",
+                    item.get_content(),
+                    compress_type=self._compress_type(item)
                 )
-                book.add_item(epub_item)
+            else:
+                self.out.writestr(item.file_name, item.get_content())
+
+def write_epub(output_file, book):
+    """
+    Same as ebooklib's epub.write_epub(), but uses StreamingEpubWriter
+    and deflates text at _DEFLATE_LEVEL.
+    """
+    writer = StreamingEpubWriter(output_file, book, {"compresslevel": _DEFLATE_LEVEL})
+    writer.process()
+    writer.write()
+
+def set_cover_from_file(book, cover_path, file_name="cover.jpg"):
+    """
+    Same as EpubBook.set_cover(), but the image is read from `cover_path` only when the ePub is written.
+    """
+    book.add_item(EpubCoverFile(cover_path, file_name=file_name))
+    book.add_item(epub.EpubCoverHtml(image_name=file_name))
+    book.add_metadata(None, "meta", "", OrderedDict([("name", "cover"), ("content", "cover-img")]))
+
+def add_media_to_epub(media_dir, book, media_index=None):
+    """
+    Scans `media_dir` (or the files of a `media_index` from build_media_index())
+    and adds recognized image files to the ePub.
+    This ensures they are included in the final output.epub package.
+    Images whose content was already added (e.g. the same logo in several chapters)
+    are stored only once. Returns this chapter's mapping of duplicate name -> stored
+    name, for rewrite_image_sources() to point the chapter at the stored copy.
+    Images are added as EpubFileItem, so their content is only read when the ePub is written.
+    All images share one folder in the ePub: a different image whose name another
+    chapter already uses is stored as "<stem>-<hash>.<ext>" (and renamed the same way).
+    Within media_dir only the first file of a name is added; files at the top
+    (where the converted images are written) go first.
+    """
+    if media_index is None:
+        media_index = build_media_index(media_dir)
+    renames = {}
+    if not media_index:
+        return renames
+
+    # Content hash -> file name, shared by all add_media_to_epub() calls for this book
+    seen_hashes = getattr(book, "media_hashes", None)
+    if seen_hashes is None:
+        seen_hashes = book.media_hashes = {}
+
+    stored_names = set(seen_hashes.values())
+    chapter_names = set()
+
+    # sorted() is stable, so this only moves files in subfolders after the top-level ones
+    for rel_path, file_path in sorted(media_index.items(), key=lambda entry: "/" in entry[0]):
+        name = rel_path[rel_path.rfind("/") + 1:]
+        dot = name.rfind(".")
+        # Names without an extension are never images (and "png" alone is not ".png")
+        media_type = _MIME.get(name[dot + 1:].lower()) if dot > 0 else None
+        if media_type:
+            if name in chapter_names:
+                # Usually the original of an image converted to the same name
+                logger.info(f"Another image named '{name}' is already in this chapter. Skipping '{file_path}'.")
+                continue
+
+            h = hashlib.blake2b(digest_size=16)
+            try:
+                with open(file_path, "rb", buffering=0) as f:
+                    for chunk in iter(lambda: f.read(1 << 20), b""):
+                        h.update(chunk)
+            except FileNotFoundError:
+                # An output of other settings, deleted since media_index was built
+                continue
+            chapter_names.add(name)
+
+            digest = h.hexdigest()
+            canonical_name = seen_hashes.get(digest)
+            if canonical_name is not None:
+                if canonical_name != name:
+                    renames[name] = canonical_name
+                continue
+            stored_name = name
+            if stored_name in stored_names:
+                # A different image of the same name from another chapter
+                stored_name = f"{name[:dot]}-{digest[:8]}{name[dot:]}"
+                renames[name] = stored_name
+            seen_hashes[digest] = stored_name
+            stored_names.add(stored_name)
+
+            epub_item = EpubFileItem(
+                file_path,
+                uid=stored_name,
+                file_name=stored_name,
+                media_type=media_type
+            )
+            book.add_item(epub_item)
+
+    return renames
+
+def rewrite_image_sources(chapters, renames):
+    """
+    Rewrites src="<duplicate>" to src="<stored name>" in the HTML (str or bytes) of
+    the chapters, using the mapping returned by add_media_to_epub() for them.
+    """
+    if not renames:
+        return
+
+    alternatives = "|".join(re.escape(name) for name in renames)
+    str_pattern = re.compile(f'src="({alternatives})"')
+    bytes_pattern = re.compile(f'src="({alternatives})"'.encode("utf-8"))
+    str_sources = {name: f'src="{stored}"' for name, stored in renames.items()}
+    bytes_sources = {name.encode("utf-8"): src.encode("utf-8") for name, src in str_sources.items()}
+
+    for chapter in chapters:
+        content = chapter.content
+        if isinstance(content, bytes):
+            pattern, sources, empty = bytes_pattern, bytes_sources, b""
+        else:
+            pattern, sources, empty = str_pattern, str_sources, ""
+
+        # split() leaves the duplicate names at the odd positions: swap those and join,
+        # instead of calling back into Python for every match like sub() would
+        parts = pattern.split(content)
+        if len(parts) == 1:
+            continue
+        parts[1::2] = [sources[name] for name in parts[1::2]]
+        chapter.content = empty.join(parts)
+
+def _prepare_chapter(tex_file, html_bytes, media_dir, html_dir=None, max_width=DEFAULT_MAX_WIDTH):
+    """
+    Cleans up the HTML Pandoc produced for `tex_file` for the ePub (image placeholders;
+    the multicols leftovers are already gone, see convert_tex_to_html()).
+    Does not touch the EpubBook, so it can run off the main thread.
+    Returns (content, media_dir, media_index), or None if the conversion failed.
+    """
+    if html_bytes is None:
+        print(f"Warning: Failed to convert '{tex_file}' to HTML. Skipping.")
+        logger.info(f"Warning: Failed to convert '{tex_file}' to HTML.")
+        return None
+
+    # Keep a copy of Pandoc's output in the debug folder if needed
+    if html_dir:
+        (Path(html_dir) / Path(tex_file).with_suffix(".html").name).write_bytes(html_bytes)
+
+    needs_transforms = needs_html_transforms(html_bytes)
+
+    # One walk of media_dir, shared by the image rewrite and add_media_to_epub()
+    media_index = build_media_index(media_dir) if media_dir else None
+
+    if not needs_transforms:
+        # Nothing to rewrite, so hand the raw bytes to ebooklib
+        return html_bytes, media_dir, media_index
+
+    html_content = html_bytes.decode("utf-8")
+    del html_bytes
+
+    # Replace placeholders with <img> and compress images to ~60
+    tex_dir = Path(tex_file).parent
+    html_content = replace_image_references_in_html(html_content, media_dir, tex_dir, media_index, max_width)
+    return html_content, media_dir, media_index
+
+def _add_chapter(book, index, result, extract_media):
+    """
+    Adds one chapter prepared by _prepare_chapter() to the book, with its images.
+    Returns the EpubHtml item, or None if the conversion failed.
+    """
+    if result is None:
+        return None
+    content, media_dir, media_index = result
+
+    # Create ePub chapter
+    chapter = epub.EpubHtml(
+        title=f"Chapter {index + 1}",
+        file_name=f"chapter_{index + 1}.xhtml",
+        lang="en"
+    )
+    chapter.content = content
+    book.add_item(chapter)
+    book.spine.append(chapter)
+
+    # Finally add images from media_dir (the newly-compressed images)
+    if extract_media:
+        # Duplicate names are per chapter: the same name can be another image elsewhere
+        renames = add_media_to_epub(media_dir, book, media_index)
+        rewrite_image_sources([chapter], renames)
+
+    return chapter
 
 def convert_tex_to_epub(config_path):
     """
     Reads a JSON config and converts multiple .tex files into one .epub.
+    - Runs Pandoc for all materials in parallel (up to "parallel" workers),
     - Possibly uses a cover image,
     - Ignores {multicols} environment,
     - Compresses all images to ~quality=60 (PDF->JPG, PNG->JPG, etc.),
     - Ensures final images are placed in media_dir, then calls add_media_to_epub().
     """
-    with open(config_path, 'r') as config_file:
-        config = json.load(config_file)
+    with open(config_path, 'rb') as config_file:
+        config = load_json(config_file)
 
     cover_path = config.get("cover")
     materials = config.get("materials", [])
     template = config.get("template")
     extract_media = config.get("extractMedia", False)
     debug = config.get("debug", False)
+    parallel = config.get("parallel") or os.cpu_count() or 1
+    max_width = config.get("maxWidth", DEFAULT_MAX_WIDTH)
+    pandoc_timeout = config.get("pandocTimeout") or DEFAULT_PANDOC_TIMEOUT
 
     if not materials:
         raise ValueError("No materials specified in the configuration file.")
@@ -194,8 +1441,8 @@ def convert_tex_to_epub(config_path):
     log_file = None
     if debug:
         log_file = f"{Path(config_path).stem}.log"
-        with open(log_file, "w") as log:
-            log.write("Debugging enabled. Starting conversion.\n")
+    configure_debug_log(log_file)
+    logger.info("Debugging enabled. Starting conversion.")
 
     # Create new ePub
     book = epub.EpubBook()
@@ -205,13 +1452,10 @@ def convert_tex_to_epub(config_path):
 
     # Add cover if available
     if cover_path and Path(cover_path).is_file():
-        with open(cover_path, 'rb') as cover_file:
-            book.set_cover("cover.jpg", cover_file.read())
+        set_cover_from_file(book, cover_path)
     else:
         print("Warning: Cover file not found or not specified. Proceeding without a cover.")
-        if debug and log_file:
-            with open(log_file, "a") as log:
-                log.write("Warning: Cover file not found.\n")
+        logger.info("Warning: Cover file not found.")
 
     # Debug directory for .html if needed
     html_dir = None
@@ -219,59 +1463,64 @@ def convert_tex_to_epub(config_path):
         html_dir = f"{Path(config_path).stem}-html"
         os.makedirs(html_dir, exist_ok=True)
 
+    # The Pandoc server cannot extract media, so only use it when media is not extracted
+    server = None if extract_media else PandocServer(pandoc_timeout)
+
+    # Pass 1: collect existing materials, then run Pandoc on them in parallel
+    order = []
     for index, tex_file in enumerate(materials):
         if not Path(tex_file).is_file():
             print(f"Warning: File '{tex_file}' not found. Skipping.")
-            if debug and log_file:
-                with open(log_file, "a") as log:
-                    log.write(f"Warning: File '{tex_file}' not found. Skipping.\n")
+            logger.info(f"Warning: File '{tex_file}' not found. Skipping.")
             continue
+        order.append(index)
 
-        # Pandoc .tex -> .html
-        html_file, media_dir = convert_tex_to_html(
-            tex_file,
-            template=template,
-            extract_media=extract_media,
-            debug=debug,
-            log_file=log_file
-        )
-        if not html_file or not Path(html_file).is_file():
-            print(f"Warning: Failed to convert '{tex_file}' to HTML. Skipping.")
-            if debug and log_file:
-                with open(log_file, "a") as log:
-                    log.write(f"Warning: Failed to convert '{tex_file}' to HTML.\n")
-            continue
-
-        # Move the .html to debug folder if needed
-        if debug and html_dir:
-            debug_html_path = Path(html_dir) / Path(html_file).name
-            Path(html_file).rename(debug_html_path)
-            html_file = debug_html_path
-
-        # Read the generated HTML
-        with open(html_file, 'r', encoding='utf-8') as file:
-            html_content = file.read()
+    # Pandoc .tex -> .html (one process per material, capped by "parallel").
+    # Each worker thread only waits on its pandoc process (or the server), so threads
+    # overlap the conversions without starting a Python interpreter per worker.
+    # As each conversion finishes, its HTML is read and cleaned up on a single
+    # background thread, so that work overlaps with the conversions still running.
+    # Chapters are assembled serially (ebooklib is not thread-safe) in original order,
+    # each one as soon as it and all chapters before it are ready.
+    prepared = {}
+    assembled = 0
 
-        # Remove traces of {multicols}
-        html_content = remove_multicols_html(html_content)
+    def assemble_ready(wait=False):
+        nonlocal assembled
+        while assembled < len(order):
+            future = prepared.get(order[assembled])
+            if future is None or not (wait or future.done()):
+                return
+            _add_chapter(book, order[assembled], future.result(), extract_media)
+            assembled += 1
 
-        # Replace placeholders with <img>, compress images to ~60
-        tex_dir = Path(tex_file).parent
-        html_content = replace_image_references_in_html(html_content, media_dir, tex_dir)
-
-        # Create ePub chapter
-        chapter = epub.EpubHtml(
-            title=f"Chapter {index + 1}",
-            file_name=f"chapter_{index + 1}.xhtml",
-            lang="en"
-        )
-        chapter.content = html_content
-        book.add_item(chapter)
-        book.spine.append(chapter)
-
-        # Finally add images from media_dir (the newly-compressed .jpg files)
-        if extract_media:
-            add_media_to_epub(media_dir, book)
+    try:
+        if order:
+            with ThreadPoolExecutor(max_workers=min(parallel, len(order))) as executor, \
+                    ThreadPoolExecutor(max_workers=1) as preparer:
+                # Future -> material index, so results can be put back in order
+                futures = {
+                    executor.submit(
+                        convert_tex_to_html,
+                        materials[index],
+                        template=template,
+                        extract_media=extract_media,
+                        debug=debug,
+                        server=server
+                    ): index
+                    for index in order
+                }
+                for future in as_completed(futures):
+                    index = futures[future]
+                    html_bytes, media_dir = future.result()
+                    prepared[index] = preparer.submit(
+                        _prepare_chapter, materials[index], html_bytes, media_dir, html_dir, max_width
+                    )
+                    assemble_ready()
+                assemble_ready(wait=True)
+    finally:
+        if server:
+            server.stop()
 
     # Navigation
     book.add_item(epub.EpubNcx())
@@ -279,11 +1528,9 @@ def convert_tex_to_epub(config_path):
 
     # Write final ePub
     output_file = "output.epub"
-    epub.write_epub(output_file, book)
+    write_epub(output_file, book)
     print(f"ePub file '{output_file}' has been successfully generated.")
-    if debug and log_file:
-        with open(log_file, "a") as log:
-            log.write(f"ePub file '{output_file}' successfully generated.\n")
+    logger.info(f"ePub file '{output_file}' successfully generated.")
 
 if __name__ == "__main__":
     config_path = input("Enter the path to the configuration JSON file: ").strip()